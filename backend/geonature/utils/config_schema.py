@@ -69,6 +69,11 @@ class GnPySchemaConf(Schema):
         ),
     )
     SQLALCHEMY_TRACK_MODIFICATIONS = fields.Boolean(missing=False)
+    # pool de connexions à la base de données (par processus),
+    # valeurs par défaut de Flask-SQLAlchemy si non renseignés
+    SQLALCHEMY_POOL_SIZE = fields.Integer()
+    SQLALCHEMY_MAX_OVERFLOW = fields.Integer()
+    SQLALCHEMY_POOL_RECYCLE = fields.Integer()
     SESSION_TYPE = fields.String(missing="filesystem")
     SECRET_KEY = fields.String(required=True)
     # le cookie expire toute les 7 jours par défaut
@@ -2,14 +2,24 @@
 Fonctions utilitaires
 """
 import json
+import zlib
+from decimal import Decimal
 from functools import wraps
+from operator import attrgetter
+
+try:
+    import orjson
+except ImportError:
+    # optional dependency (pip install orjson, python >= 3.6),
+    # not in requirements.txt: the json module is used without it
+    orjson = None
 
 from dateutil import parser
-from flask import Response
+from flask import Response, stream_with_context
 from werkzeug.datastructures import Headers
 
-from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy import MetaData
+from sqlalchemy.dialects.postgresql import UUID, JSON
+from sqlalchemy import MetaData, Text, cast, func, literal_column
 
 from geojson import Feature, FeatureCollection
 
@@ -157,12 +167,66 @@ class GenericTable:
 
         return {item: _serializer(getattr(data, item)) for item, _serializer in fprops}
 
+    def as_dict_serializer(self, columns=None):
+        """
+        Return a function serializing a row as as_dict does, with the
+        selection of the columns, their getters and serializers resolved
+        once: to use on each row of a large query
+        Parameters:
+            columns (list): columns to serialize, all if empty
+        """
+        fprops = [
+            (name, attrgetter(name), _serializer)
+            for name, _serializer in self.serialize_columns
+            if not columns or name in columns
+        ]
+
+        def serialize(data):
+            return {name: _serializer(get(data)) for name, get, _serializer in fprops}
+
+        return serialize
+
     def as_geofeature(self, data, columns=None):
         if getattr(data, self.geometry_field) is not None:
             geometry = to_shape(getattr(data, self.geometry_field))
 
             return Feature(geometry=geometry, properties=self.as_dict(data, columns))
 
+    def as_geofeature_query(self, query, columns=None):
+        """
+        Return a query building in the database (ST_AsGeoJSON) the GeoJSON
+        Feature of each row of a query, so that no row is serialized in Python
+        Parameters:
+            query (SQLA Query): query on the tableDef (with its filters)
+            columns (list): properties of the features, all if empty
+        Returns
+            SQLA Query returning one Feature as a json string per row
+        """
+        geom_col = self.tableDef.columns[self.geometry_field]
+        prop_cols = [
+            self.tableDef.columns[name]
+            for name, _serializer in self.serialize_columns
+            if not columns or name in columns
+        ]
+        feature_data = (
+            query.with_entities(*prop_cols, geom_col)
+            .filter(geom_col.isnot(None))
+            .subquery("feature_data")
+        )
+        feature = func.json_build_object(
+            "type",
+            "Feature",
+            "geometry",
+            cast(func.ST_AsGeoJSON(feature_data.c[self.geometry_field]), JSON),
+            "properties",
+            func.to_jsonb(literal_column(feature_data.name)).op("-")(
+                self.geometry_field
+            ),
+        )
+        return DB.session.query(cast(feature, Text).label("feature")).select_from(
+            feature_data
+        )
+
     def as_shape(
         self, db_cols, geojson_col=None, data=[], dir_path=None, file_name=None
     ):
@@ -410,13 +474,20 @@ def serializable(cls):
     return cls
 
 
+# default of the geojson parameter of as_geofeature: an explicit None
+# is the GeoJSON of a NULL geometry, not a missing value
+NOT_GIVEN = object()
+
+
 def geoserializable(cls):
     """
         Décorateur de classe
         Permet de rajouter la fonction as_geofeature à une classe
     """
 
-    def serializegeofn(self, geoCol, idCol, recursif=False, columns=()):
+    def serializegeofn(
+        self, geoCol, idCol, recursif=False, columns=(), geojson=NOT_GIVEN
+    ):
         """
         Méthode qui renvoie les données de l'objet sous la forme
         d'une Feature geojson
@@ -432,8 +503,17 @@ def geoserializable(cls):
             également sérialisé
            columns: liste
             liste des columns qui doivent être prisent en compte
+           geojson: string
+            Géométrie déjà encodée en GeoJSON (par ST_AsGeoJSON),
+            évite la conversion de la géométrie avec shapely
+            (None : géométrie nulle, la colonne n'est pas lue)
         """
-        if not getattr(self, geoCol) is None:
+        if geojson is not NOT_GIVEN:
+            if geojson is not None:
+                geometry = json.loads(geojson)
+            else:
+                geometry = {"type": "Point", "coordinates": [0, 0]}
+        elif not getattr(self, geoCol) is None:
             geometry = to_shape(getattr(self, geoCol))
         else:
             geometry = {"type": "Point", "coordinates": [0, 0]}
@@ -466,6 +546,26 @@ def json_resp(fn):
     return _json_resp
 
 
+def _orjson_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError
+
+
+def json_dumps(obj, indent=None):
+    """
+    Serialize obj to json with orjson (C encoder) if it is installed,
+    with the json module otherwise or if an indentation is asked
+    """
+    if orjson is not None and indent is None:
+        return orjson.dumps(
+            obj,
+            default=_orjson_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC,
+        )
+    return json.dumps(obj, ensure_ascii=False, indent=indent)
+
+
 def to_json_resp(
     res, status=200, filename=None, as_file=False, indent=None, extension="json"
 ):
@@ -483,7 +583,7 @@ def to_json_resp(
             filename="export_{}.{}".format(filename, extension),
         )
     return Response(
-        json.dumps(res, ensure_ascii=False, indent=indent),
+        json_dumps(res, indent=indent),
         status=status,
         mimetype="application/json",
         headers=headers,
@@ -504,17 +604,92 @@ def csv_resp(fn):
     return _csv_resp
 
 
-def to_csv_resp(filename, data, columns, separator):
-    outdata = [separator.join(columns)]
+def generate_csv_content(data, columns, separator):
+    """
+    Generator of the lines of a csv file
+    Parameters:
+        data (iterable<dict>): the rows
+        columns (list): the columns to export
+        separator (str): the csv separator
+    """
+    yield separator.join(columns)
+    for o in data:
+        yield "\r\n" + separator.join(
+            '"%s"' % (o.get(i), "")[o.get(i) is None] for i in columns
+        )
 
+
+def get_csv_headers(filename):
     headers = Headers()
     headers.add("Content-Type", "text/plain")
     headers.add(
         "Content-Disposition", "attachment", filename="export_%s.csv" % filename
     )
-    for o in data:
-        outdata.append(
-            separator.join('"%s"' % (o.get(i), "")[o.get(i) is None] for i in columns)
-        )
-    out = "\r\n".join(outdata)
-    return Response(out, headers=headers)
+    return headers
+
+
+def to_csv_resp(filename, data, columns, separator):
+    out = "".join(generate_csv_content(data, columns, separator))
+    return Response(out, headers=get_csv_headers(filename))
+
+
+def to_csv_stream_resp(filename, data, columns, separator):
+    """
+    Same as to_csv_resp, but the file is streamed while `data` is iterated
+    (data can be a generator fetching the rows from the database)
+    """
+    return Response(
+        stream_with_context(generate_csv_content(data, columns, separator)),
+        headers=get_csv_headers(filename),
+    )
+
+
+def generate_geojson_feature_collection(features):
+    """
+    Generator of a GeoJSON FeatureCollection
+    Parameters:
+        features (iterable<str>): the features already encoded in json
+    """
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ""
+    for feature in features:
+        yield separator + feature
+        separator = ", "
+    yield "]}"
+
+
+def generate_gzip(chunks, level=6):
+    """
+    Generator compressing on the fly (gzip format) a stream of text
+    Parameters:
+        chunks (iterable<str>): the text to compress
+        level (int): zlib compression level
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def to_geojson_stream_resp(filename, features, gzip=False):
+    """
+    Return a streamed GeoJSON file from json encoded features
+    Parameters:
+        gzip (boolean): compress the stream (Content-Encoding: gzip),
+            to use only if the client accepts it
+    """
+    headers = Headers()
+    headers.add(
+        "Content-Disposition", "attachment", filename="export_%s.geojson" % filename
+    )
+    # the body depends on Accept-Encoding, compressed or not
+    headers.add("Vary", "Accept-Encoding")
+    content = generate_geojson_feature_collection(features)
+    if gzip:
+        content = generate_gzip(content)
+        headers.add("Content-Encoding", "gzip")
+    return Response(
+        stream_with_context(content), mimetype="application/geo+json", headers=headers
+    )
@@ -1,3 +1,4 @@
+import gzip
 import json
 import pytest
 from flask import url_for, session, Response, request
@@ -6,6 +7,8 @@ from cookies import Cookie
 
 from pypnusershub.db.tools import InsufficientRightsError
 
+from geonature.utils.env import DB
+
 
 @pytest.mark.usefixtures("client_class")
 class TestApiModulePrOcctax:
@@ -43,6 +46,19 @@ class TestApiModulePrOcctax:
             json_data["items"]["features"][0]["properties"]["observers_txt"] == "test"
         )
 
+        # the releve 1 has an occurrence of each taxon: it is returned once
+        response = self.client.get(
+            url_for("pr_occtax.getViewReleveList"),
+            query_string={"id_dataset": 1, "cd_nom": [60612, 713776]},
+        )
+        assert response.status_code == 200
+        json_data = json_of_response(response)
+        ids = [
+            f["properties"]["id_releve_occtax"] for f in json_data["items"]["features"]
+        ]
+        assert ids.count(1) == 1
+        assert json_data["total_filtered"] == len(set(ids))
+
     def test_insert_update_delete_releves(self, releve_data):
         token = get_token(self.client)
         self.client.set_cookie("/", "token", token)
@@ -103,6 +119,83 @@ class TestApiModulePrOcctax:
 
         assert response.status_code == 200
 
+    def test_insert_releve_occurrences_countings(self, releve_data):
+        """
+            each counting is inserted with its occurrence,
+            the unknown observers are ignored
+        """
+        token = get_token(self.client)
+        self.client.set_cookie("/", "token", token)
+
+        releve_data["properties"]["observers"] = [1, 999999999]
+        occurrence = releve_data["properties"]["t_occurrences_occtax"][0]
+        counting = occurrence["cor_counting_occtax"][0]
+        # the second occurrence and its countings post fewer keys
+        other_occurrence = {
+            k: v for k, v in occurrence.items() if k not in ("comment", "determiner")
+        }
+        other_occurrence["cd_nom"] = 60612
+        other_occurrence["cor_counting_occtax"] = [
+            {k: v for k, v in counting.items() if k != "count_max"} for _ in range(2)
+        ]
+        other_occurrence["cor_counting_occtax"][0]["count_min"] = 5
+        other_occurrence["cor_counting_occtax"][1]["count_min"] = 6
+        occurrence["cor_counting_occtax"][0]["count_min"] = 3
+        releve_data["properties"]["t_occurrences_occtax"].append(other_occurrence)
+
+        response = post_json(
+            self.client, url_for("pr_occtax.insertOrUpdateOneReleve"), releve_data
+        )
+        assert response.status_code == 200
+        releve = json_of_response(response)["properties"]
+
+        assert [o["id_role"] for o in releve["observers"]] == [1]
+        counts_by_taxon = {
+            occ["cd_nom"]: sorted(
+                cnt["count_min"] for cnt in occ["cor_counting_occtax"]
+            )
+            for occ in releve["t_occurrences_occtax"]
+        }
+        assert counts_by_taxon == {67111: [3], 60612: [5, 6]}
+        for occ in releve["t_occurrences_occtax"]:
+            for cnt in occ["cor_counting_occtax"]:
+                assert cnt["id_occurrence_occtax"] == occ["id_occurrence_occtax"]
+
+        response = self.client.delete(
+            url_for("pr_occtax.deleteOneReleve", id_releve=releve["id_releve_occtax"])
+        )
+        assert response.status_code == 200
+
+    def test_insert_releve_column_defaults(self, releve_data):
+        """
+            the values posted as null get the default of their column
+            (the form posts meta_v_taxref = null)
+        """
+        token = get_token(self.client)
+        self.client.set_cookie("/", "token", token)
+
+        occurrence = releve_data["properties"]["t_occurrences_occtax"][0]
+        occurrence["meta_v_taxref"] = None
+        occurrence["cor_counting_occtax"][0]["unique_id_sinp_occtax"] = None
+
+        response = post_json(
+            self.client, url_for("pr_occtax.insertOrUpdateOneReleve"), releve_data
+        )
+        assert response.status_code == 200
+        releve = json_of_response(response)["properties"]
+
+        taxref_version = DB.session.execute(
+            "SELECT gn_commons.get_default_parameter('taxref_version')"
+        ).scalar()
+        occurrence = releve["t_occurrences_occtax"][0]
+        assert occurrence["meta_v_taxref"] == taxref_version
+        assert occurrence["cor_counting_occtax"][0]["unique_id_sinp_occtax"]
+
+        response = self.client.delete(
+            url_for("pr_occtax.deleteOneReleve", id_releve=releve["id_releve_occtax"])
+        )
+        assert response.status_code == 200
+
     def test_get_export_sinp(self):
         token = get_token(self.client)
         self.client.set_cookie("/", "token", token)
@@ -147,6 +240,71 @@ class TestApiModulePrOcctax:
         )
         assert response.status_code == 200
 
+        # the releve 1 has an occurrence of each taxon and 3 countings:
+        # each counting is exported once (admin sees all the releves)
+        token = get_token(self.client)
+        self.client.set_cookie("/", "token", token)
+
+        query_string = {
+            "id_dataset": 1,
+            "cd_nom": [60612, 713776],
+            "date_up": "2017-05-11",
+            "date_low": "2009-05-01",
+            "format": "geojson",
+        }
+        response = self.client.get(
+            url_for("pr_occtax.export"), query_string=query_string
+        )
+        assert response.status_code == 200
+        data = json_of_response(response)
+        perm_ids = [f["properties"]["permId"] for f in data["features"]]
+        assert len(perm_ids) == 3
+        assert len(set(perm_ids)) == len(perm_ids)
+
+        query_string["format"] = "csv"
+        response = self.client.get(
+            url_for("pr_occtax.export"), query_string=query_string
+        )
+        assert response.status_code == 200
+        # header + one line per counting
+        lines = response.data.decode("utf8").strip().splitlines()
+        assert len(lines) == 4
+
+    def test_export_geojson_gzip(self):
+        token = get_token(self.client)
+        self.client.set_cookie("/", "token", token)
+
+        query_string = {
+            "id_dataset": 1,
+            "cd_nom": [60612, 713776],
+            "date_up": "2017-05-11",
+            "date_low": "2009-05-01",
+            "format": "geojson",
+        }
+        response = self.client.get(
+            url_for("pr_occtax.export"),
+            query_string=query_string,
+            headers={"Accept-Encoding": "gzip"},
+        )
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.headers["Vary"] == "Accept-Encoding"
+        data = json.loads(gzip.decompress(response.data).decode("utf8"))
+        assert data["type"] == "FeatureCollection"
+        assert len(data["features"]) == 3
+
+        # gzip refused by the client
+        response = self.client.get(
+            url_for("pr_occtax.export"),
+            query_string=query_string,
+            headers={"Accept-Encoding": "gzip;q=0"},
+        )
+        assert response.status_code == 200
+        assert "Content-Encoding" not in response.headers
+        assert response.headers["Vary"] == "Accept-Encoding"
+        data = json_of_response(response)
+        assert len(data["features"]) == 3
+
     # ## Test des droits ####
     def test_get_and_delete_releve(self):
         """
@@ -167,6 +325,51 @@ class TestApiModulePrOcctax:
         self.client.set_cookie("/", "token", token)
 
         with pytest.raises(InsufficientRightsError):
-            response = self.client.get(
+            response = self.client.delete(
                 url_for("pr_occtax.deleteOneReleve", id_releve=1)
             )
+
+    def test_delete_missing_releve(self):
+        token = get_token(self.client, login="agent", password="admin")
+        self.client.set_cookie("/", "token", token)
+
+        response = self.client.delete(
+            url_for("pr_occtax.deleteOneReleve", id_releve=999999999)
+        )
+        assert response.status_code == 404
+
+    def test_owner_can_delete_releve(self, releve_data):
+        """
+            user agent (D scope 1) is the digitiser of the releve it posts
+        """
+        token = get_token(self.client, login="agent", password="admin")
+        self.client.set_cookie("/", "token", token)
+
+        response = post_json(
+            self.client, url_for("pr_occtax.insertOrUpdateOneReleve"), releve_data
+        )
+        assert response.status_code == 200
+        releve = json_of_response(response)["properties"]
+        id_releve = releve["id_releve_occtax"]
+        id_occurrences = tuple(
+            occ["id_occurrence_occtax"] for occ in releve["t_occurrences_occtax"]
+        )
+
+        response = self.client.delete(
+            url_for("pr_occtax.deleteOneReleve", id_releve=id_releve)
+        )
+        assert response.status_code == 200
+
+        # the occurrences and their countings are deleted with the releve
+        nb_occurrences = DB.session.execute(
+            "SELECT count(*) FROM pr_occtax.t_occurrences_occtax "
+            "WHERE id_releve_occtax = :id",
+            {"id": id_releve},
+        ).scalar()
+        assert nb_occurrences == 0
+        nb_countings = DB.session.execute(
+            "SELECT count(*) FROM pr_occtax.cor_counting_occtax "
+            "WHERE id_occurrence_occtax IN :ids",
+            {"ids": id_occurrences},
+        ).scalar()
+        assert nb_countings == 0
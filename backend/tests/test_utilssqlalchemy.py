@@ -0,0 +1,15 @@
+import gzip
+import json
+
+from geonature.utils.utilssqlalchemy import generate_gzip
+
+
+def test_generate_gzip():
+    chunks = ['{"type": "FeatureCollection", "features": [', "]}"]
+    data = b"".join(generate_gzip(iter(chunks)))
+    assert gzip.decompress(data).decode("utf8") == "".join(chunks)
+    assert json.loads(gzip.decompress(data).decode("utf8"))["features"] == []
+
+
+def test_generate_gzip_empty():
+    assert gzip.decompress(b"".join(generate_gzip(iter(())))) == b""
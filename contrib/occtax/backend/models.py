@@ -7,7 +7,7 @@ from geoalchemy2 import Geometry
 
 from pypnnomenclature.models import TNomenclatures
 
-from geonature.utils.utilssqlalchemy import serializable, geoserializable
+from geonature.utils.utilssqlalchemy import serializable, geoserializable, NOT_GIVEN
 from geonature.utils.env import DB
 from pypnusershub.db.tools import InsufficientRightsError
 from pypnusershub.db.models import User
@@ -27,13 +27,18 @@ class ReleveModel(DB.Model):
         observers = [d.id_role for d in self.observers]
         return user.id_role == self.id_digitiser or user.id_role in observers
 
-    def user_is_in_dataset_actor(self, user):
-        return self.id_dataset in TDatasets.get_user_datasets(user)
+    def user_is_in_dataset_actor(self, user, user_datasets=None):
+        if user_datasets is None:
+            user_datasets = TDatasets.get_user_datasets(user)
+        return self.id_dataset in user_datasets
 
-    def user_is_allowed_to(self, user, level):
+    def user_is_allowed_to(self, user, level, user_datasets=None):
         """
             Fonction permettant de dire si un utilisateur
             peu ou non agir sur une donnée
+            params:
+                - user_datasets: the datasets of the user
+                  (fetched from the DB if None)
         """
         # Si l'utilisateur n'a pas de droit d'accès aux données
         if level == "0" or level not in ("1", "2", "3"):
@@ -49,8 +54,9 @@ class ReleveModel(DB.Model):
 
         # Si l'utilisateur appartient à un organisme
         # qui a un droit sur la données et
-        # que son niveau d'accès est 2 ou 3
-        if self.user_is_in_dataset_actor(user) and level in ("2", "3"):
+        # que son niveau d'accès est 2 (3 est déjà autorisé)
+        # the datasets are only fetched for this level
+        if level == "2" and self.user_is_in_dataset_actor(user, user_datasets):
             return True
         return False
 
@@ -70,16 +76,21 @@ class ReleveModel(DB.Model):
             403,
         )
 
-    def get_releve_cruved(self, user, user_cruved):
+    def get_releve_cruved(self, user, user_cruved, user_datasets=None):
         """
         Return the user's cruved for a Releve instance.
         Use in the map-list interface to allow or not an action
         params:
             - user : a TRole object
             - user_cruved: object return by cruved_for_user_in_app(user)
+            - user_datasets: the datasets of the user, to pass when
+              the cruved of several releves is computed
+              (fetched from the DB if None, only if a level is "2")
         """
+        if user_datasets is None and "2" in user_cruved.values():
+            user_datasets = TDatasets.get_user_datasets(user)
         return {
-            action: self.user_is_allowed_to(user, level)
+            action: self.user_is_allowed_to(user, level, user_datasets)
             for action, level in user_cruved.items()
         }
 
@@ -132,6 +143,9 @@ class TOccurrencesOccurrence(DB.Model):
     __tablename__ = "t_occurrences_occtax"
     __table_args__ = {"schema": "pr_occtax"}
     id_occurrence_occtax = DB.Column(DB.Integer, primary_key=True)
+    unique_id_occurence_occtax = DB.Column(
+        UUID(as_uuid=True), default=select([func.uuid_generate_v4()])
+    )
     id_releve_occtax = DB.Column(
         DB.Integer, ForeignKey("pr_occtax.t_releves_occtax.id_releve_occtax")
     )
@@ -161,6 +175,7 @@ class TOccurrencesOccurrence(DB.Model):
         "CorCountingOccurrence",
         lazy="joined",
         cascade="all,delete-orphan",
+        passive_deletes=True,
         uselist=True,
     )
 
@@ -188,7 +203,10 @@ class TRelevesOccurrence(ReleveModel):
     geom_local = DB.Column(Geometry("GEOMETRY", current_app.config["LOCAL_SRID"]))
 
     t_occurrences_occtax = relationship(
-        "TOccurrencesOccurrence", lazy="joined", cascade="all, delete-orphan"
+        "TOccurrencesOccurrence",
+        lazy="joined",
+        cascade="all, delete-orphan",
+        passive_deletes=True,
     )
 
     observers = DB.relationship(
@@ -206,8 +224,10 @@ class TRelevesOccurrence(ReleveModel):
         User, primaryjoin=(User.id_role == id_digitiser), foreign_keys=[id_digitiser]
     )
 
-    def get_geofeature(self, recursif=True):
-        return self.as_geofeature("geom_4326", "id_releve_occtax", recursif)
+    def get_geofeature(self, recursif=True, geojson=NOT_GIVEN):
+        return self.as_geofeature(
+            "geom_4326", "id_releve_occtax", recursif, geojson=geojson
+        )
 
 
 @serializable
@@ -244,8 +264,10 @@ class VReleveOccurrence(ReleveModel):
         ],
     )
 
-    def get_geofeature(self, recursif=True):
-        return self.as_geofeature("geom_4326", "id_occurrence_occtax", recursif)
+    def get_geofeature(self, recursif=True, geojson=NOT_GIVEN):
+        return self.as_geofeature(
+            "geom_4326", "id_occurrence_occtax", recursif, geojson=geojson
+        )
 
 
 @serializable
@@ -281,9 +303,11 @@ class VReleveList(ReleveModel):
         ],
     )
 
-    def get_geofeature(self, recursif=True):
+    def get_geofeature(self, recursif=True, geojson=NOT_GIVEN):
 
-        return self.as_geofeature("geom_4326", "id_releve_occtax", recursif)
+        return self.as_geofeature(
+            "geom_4326", "id_releve_occtax", recursif, geojson=geojson
+        )
 
 
 @serializable
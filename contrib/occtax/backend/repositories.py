@@ -1,14 +1,19 @@
-from sqlalchemy import or_
+import uuid
+from functools import lru_cache
+
+from sqlalchemy import or_, literal, select
 from werkzeug.exceptions import NotFound
 from sqlalchemy.sql import func, and_
+from sqlalchemy.orm import joinedload, selectinload, defer
 from sqlalchemy.orm.exc import NoResultFound
 from pypnnomenclature.models import TNomenclatures
+from pypnusershub.db.models import User
 
 from geonature.utils.env import DB
 from geonature.core.gn_commons.models import VLatestValidations
 from geonature.utils.utilssqlalchemy import testDataType
 from geonature.utils.errors import GeonatureApiError
-from .utils import get_nomenclature_filters
+from .utils import get_nomenclature_filters, filter_keys
 
 from .models import (
     TRelevesOccurrence,
@@ -18,6 +23,34 @@ from .models import (
 )
 from geonature.core.gn_meta.models import TDatasets, CorDatasetActor
 
+# columns of the tables, used to INSERT a new releve
+RELEVE_COLUMNS = frozenset(TRelevesOccurrence.__table__.columns.keys())
+OCCURRENCE_COLUMNS = frozenset(TOccurrencesOccurrence.__table__.columns.keys())
+COUNTING_COLUMNS = frozenset(CorCountingOccurrence.__table__.columns.keys())
+
+
+def get_insert_values(table, values):
+    """
+        Remove from the values of an INSERT the None of the columns
+        with a default, so that the default is computed like the ORM does
+        (e.g. meta_v_taxref posted as null by the form)
+    """
+    return {
+        k: v for k, v in values.items() if v is not None or table.c[k].default is None
+    }
+
+
+def get_insert_rows(table, rows):
+    """
+        Complete the rows of a multi-row INSERT so that they all set
+        the same columns: a missing value is None, except for the columns
+        with a default, which is then computed for the row
+    """
+    rows = [get_insert_values(table, row) for row in rows]
+    keys = set().union(*rows)
+    without_default = [k for k in keys if table.columns[k].default is None]
+    return [dict(dict.fromkeys(without_default), **row) for row in rows]
+
 
 class ReleveRepository:
     """
@@ -62,31 +95,153 @@ class ReleveRepository:
                 )
         return releve, rel_as_geojson
 
+    def create(self, properties, geom_4326, observers_ids, occurrences):
+        """
+            Insert a new releve with SQLAlchemy Core, without the unit of work:
+            one INSERT ... RETURNING for the releve, then one INSERT for each
+            of its children tables (observers, occurrences, countings)
+            params:
+                - properties: the posted properties of the releve
+                - geom_4326: SQL expression of the geometry
+                - observers_ids: the posted id_role of the observers or None
+                - occurrences: list of (occurrence properties,
+                  list of countings properties)
+            Return: the id of the new releve
+        """
+        releve_table = self.model.__table__
+        releve_values = filter_keys(properties, RELEVE_COLUMNS)
+        releve_values.pop("id_releve_occtax", None)
+        releve_values["geom_4326"] = geom_4326
+        id_releve = DB.session.execute(
+            releve_table.insert()
+            .values(get_insert_values(releve_table, releve_values))
+            .returning(releve_table.c.id_releve_occtax)
+        ).scalar()
+
+        if observers_ids:
+            # only the existing roles, like the observers relationship
+            DB.session.execute(
+                corRoleRelevesOccurrence.insert().from_select(
+                    ["id_releve_occtax", "id_role", "unique_id_cor_role_releve"],
+                    select(
+                        [literal(id_releve), User.id_role, func.uuid_generate_v4()]
+                    ).where(User.id_role.in_(observers_ids)),
+                    include_defaults=False,
+                )
+            )
+
+        if not occurrences:
+            return id_releve
+        # the uuid of each occurrence is generated here to map
+        # the returned ids to the countings
+        occurrence_rows = []
+        occurrence_countings = {}
+        for occ, countings in occurrences:
+            occ = filter_keys(occ, OCCURRENCE_COLUMNS)
+            occ.pop("id_occurrence_occtax", None)
+            occ["id_releve_occtax"] = id_releve
+            occ_uuid = uuid.uuid4()
+            occ["unique_id_occurence_occtax"] = occ_uuid
+            occurrence_rows.append(occ)
+            occurrence_countings[occ_uuid] = countings
+        occurrence_table = TOccurrencesOccurrence.__table__
+        inserted = DB.session.execute(
+            occurrence_table.insert()
+            .values(get_insert_rows(occurrence_table, occurrence_rows))
+            .returning(
+                occurrence_table.c.id_occurrence_occtax,
+                occurrence_table.c.unique_id_occurence_occtax,
+            )
+        ).fetchall()
+
+        counting_rows = []
+        for id_occurrence, occ_uuid in inserted:
+            for cnt in occurrence_countings[occ_uuid]:
+                cnt = filter_keys(cnt, COUNTING_COLUMNS)
+                cnt.pop("id_counting_occtax", None)
+                cnt["id_occurrence_occtax"] = id_occurrence
+                counting_rows.append(cnt)
+        if counting_rows:
+            counting_table = CorCountingOccurrence.__table__
+            DB.session.execute(
+                counting_table.insert().values(
+                    get_insert_rows(counting_table, counting_rows)
+                )
+            )
+        return id_releve
+
     def update(self, releve, info_user, geom):
         """ Update the current releve if allowed
         params:
         - releve: a Releve object model
         - info_user: Trole object model
+
+        Return: the releve merged in the session
         """
         releve = releve.get_releve_if_allowed(info_user)
-        DB.session.merge(releve)
+        releve = DB.session.merge(releve)
         DB.session.commit()
         return releve
 
     def delete(self, id_releve, info_user):
         """Delete a releve
+        A single DELETE ... RETURNING restricted to the releves the user
+        is allowed to delete; the occurrences and countings are removed
+        by the ON DELETE CASCADE foreign keys
         params:
          - id_releve: integer
-         - info_user: TRole object model"""
+         - info_user: TRole object model
 
+        Return: the id of the deleted releve"""
+        deleted = None
+        if info_user.value_filter in ("1", "2", "3"):
+            q = self.filter_query_with_autorization(info_user).filter(
+                self.model.id_releve_occtax == id_releve
+            )
+            stmt = (
+                self.model.__table__.delete()
+                .where(q.whereclause)
+                .returning(self.model.id_releve_occtax)
+            )
+            deleted = DB.session.execute(stmt).scalar()
+        if deleted is not None:
+            DB.session.commit()
+            return deleted
+        DB.session.rollback()
+        # nothing deleted: the releve doesn't exist or the user is not allowed
         releve = DB.session.query(self.model).get(id_releve)
         if releve:
-            releve = releve.get_releve_if_allowed(info_user)
-            DB.session.delete(releve)
-            DB.session.commit()
-            return releve
+            releve.get_releve_if_allowed(info_user)
         raise NotFound('The releve "{}" does not exist'.format(id_releve))
 
+    def get_eager_load_options(self):
+        """
+            Return the loading strategies of the relationships serialized
+            by get_geofeature, to avoid one query per releve (N+1)
+            selectinload is used for the collections (one IN query per
+            relationship, no cartesian product), joinedload for many-to-one
+        """
+        options = [selectinload(self.model.observers)]
+        if hasattr(self.model, "t_occurrences_occtax"):
+            options.append(
+                selectinload(self.model.t_occurrences_occtax).selectinload(
+                    TOccurrencesOccurrence.cor_counting_occtax
+                )
+            )
+        if hasattr(self.model, "digitiser"):
+            options.append(joinedload(self.model.digitiser))
+        return options
+
+    def add_geojson_column(self, q):
+        """
+            Add to the query the geometry of the model encoded in GeoJSON
+            by PostGIS (column 'geojson'), to pass to get_geofeature.
+            The loading of the WKB geometry is deferred
+        """
+        return q.add_columns(
+            func.ST_AsGeoJSON(self.model.geom_4326).label("geojson")
+        ).options(defer(self.model.geom_4326))
+
     def filter_query_with_autorization(self, user):
         q = DB.session.query(self.model)
         if user.value_filter == "2":
@@ -139,12 +294,18 @@ class ReleveRepository:
                 )
         return q
 
-    def get_all(self, info_user):
+    def get_all(self, info_user, with_geojson=False):
         """
             Return all the data from Releve model filtered with
             the cruved authorization
+            params:
+             - with_geojson: if True, return (releve, geojson) tuples
+               (see add_geojson_column)
         """
         q = self.filter_query_with_autorization(info_user)
+        q = q.options(*self.get_eager_load_options())
+        if with_geojson:
+            q = self.add_geojson_column(q)
         data = q.all()
         if data:
             return data
@@ -156,24 +317,83 @@ class ReleveRepository:
             the cruved authorization
         """
         if not from_generic_table:
-            return self.filter_query_with_autorization(info_user)
+            q = self.filter_query_with_autorization(info_user)
+            return q.options(*self.get_eager_load_options())
         else:
             return self.filter_query_generic_table(info_user)
 
 
+# query parameters with a dedicated filter in get_query_occtax_filters
+OCCTAX_FILTER_PARAMS = frozenset(
+    (
+        "cd_nom",
+        "observers",
+        "date_up",
+        "date_low",
+        "date_eq",
+        "altitude_max",
+        "altitude_min",
+        "organism",
+        "observers_txt",
+    )
+)
+
+
+@lru_cache(maxsize=128)
+def get_filters_template(param_names, mappedView, from_generic_table=False):
+    """
+        Return the names of the query parameters used as filters:
+        generic filters on the columns of the view and nomenclature
+        filters on releve, occurrence and counting.
+        Only depends on the names of the parameters, not on their values:
+        cached for each shape of query string
+    """
+    if from_generic_table:
+        table_columns = mappedView.tableDef.columns
+    else:
+        table_columns = mappedView.__table__.columns
+    param_names = sorted(param_names)
+    generic_filters = tuple(
+        p for p in param_names if p not in OCCTAX_FILTER_PARAMS and p in table_columns
+    )
+    releve_filters, occurrence_filters, counting_filters = get_nomenclature_filters(
+        param_names
+    )
+    return (
+        generic_filters,
+        tuple(releve_filters),
+        tuple(occurrence_filters),
+        tuple(counting_filters),
+    )
+
+
 def get_query_occtax_filters(args, mappedView, q, from_generic_table=False):
+    (
+        generic_filters,
+        releve_filters,
+        occurrence_filters,
+        counting_filters,
+    ) = get_filters_template(frozenset(args.keys()), mappedView, from_generic_table)
     if from_generic_table:
         mappedView = mappedView.tableDef.columns
     params = args.to_dict()
     testT = None
     if "cd_nom" in params:
-        testT = testDataType(params.get("cd_nom"), DB.Integer, "cd_nom")
-        if testT:
-            raise GeonatureApiError(message=testT)
-        q = q.join(
-            TOccurrencesOccurrence,
-            TOccurrencesOccurrence.id_releve_occtax == mappedView.id_releve_occtax,
-        ).filter(TOccurrencesOccurrence.cd_nom == int(params.pop("cd_nom")))
+        cd_noms = args.getlist("cd_nom")
+        for cd_nom in cd_noms:
+            testT = testDataType(cd_nom, DB.Integer, "cd_nom")
+            if testT:
+                raise GeonatureApiError(message=testT)
+        # subquery rather than join: a releve is returned once
+        # even if several of its occurrences match
+        q = q.filter(
+            mappedView.id_releve_occtax.in_(
+                DB.session.query(TOccurrencesOccurrence.id_releve_occtax).filter(
+                    TOccurrencesOccurrence.cd_nom.in_([int(c) for c in cd_noms])
+                )
+            )
+        )
+        params.pop("cd_nom")
     if "observers" in params:
         q = q.join(
             corRoleRelevesOccurrence,
@@ -212,9 +432,15 @@ def get_query_occtax_filters(args, mappedView, q, from_generic_table=False):
         q = q.filter(mappedView.altitude_min >= params.pop("altitude_min"))
 
     if "organism" in params:
-        q = q.join(
-            CorDatasetActor, CorDatasetActor.id_dataset == mappedView.id_dataset
-        ).filter(CorDatasetActor.id_actor == int(params.pop("organism")))
+        organisms = [int(o) for o in args.getlist("organism")]
+        q = q.filter(
+            mappedView.id_dataset.in_(
+                DB.session.query(CorDatasetActor.id_dataset).filter(
+                    CorDatasetActor.id_actor.in_(organisms)
+                )
+            )
+        )
+        params.pop("organism")
 
     if "observers_txt" in params:
         observers_query = "%{}%".format(params.pop("observers_txt"))
@@ -226,17 +452,13 @@ def get_query_occtax_filters(args, mappedView, q, from_generic_table=False):
         table_columns = mappedView.__table__.columns
 
     # Generic Filters
-    for param in params:
-        if param in table_columns:
-            col = getattr(table_columns, param)
-            testT = testDataType(params[param], col.type, param)
-            if testT:
-                raise GeonatureApiError(message=testT)
-            q = q.filter(col == params[param])
+    for param in generic_filters:
+        col = getattr(table_columns, param)
+        testT = testDataType(params[param], col.type, param)
+        if testT:
+            raise GeonatureApiError(message=testT)
+        q = q.filter(col == params[param])
 
-    releve_filters, occurrence_filters, counting_filters = get_nomenclature_filters(
-        params
-    )
     if len(releve_filters) > 0:
         q = q.join(
             TRelevesOccurrence,
@@ -1,3 +1,9 @@
+import time
+from functools import lru_cache
+
+from sqlalchemy import func, column
+
+from geonature.utils.env import DB
 
 # nomenclatures fields
 counting_nomenclatures = [
@@ -42,4 +48,59 @@ def get_nomenclature_filters(params):
                 occurrence_filters.append(p)
             elif p in releve_nomenclatures:
                 releve_filters.append(p)
-    return releve_filters, occurrence_filters, counting_filters
\ No newline at end of file
+    return releve_filters, occurrence_filters, counting_filters
+
+
+# {model: (timestamp, count)}
+_total_count_cache = {}
+
+
+def get_cached_total_count(model, timeout=60):
+    """
+        Return the number of rows of a model without any filter.
+        The result is kept in memory (per process) for `timeout` seconds:
+        the total of a view changes slowly and counting it scans the
+        whole view
+    """
+    now = time.monotonic()
+    cached = _total_count_cache.get(model)
+    if cached and now - cached[0] < timeout:
+        return cached[1]
+    total = DB.session.query(func.count()).select_from(model).scalar()
+    _total_count_cache[model] = (now, total)
+    return total
+
+
+def get_cached_default_nomenclatures(organism, regne, group2_inpn, timeout=60):
+    """
+        Return the default nomenclature of every nomenclature type
+        for an organism (integer), a regne and a group2_inpn as a dict
+        {mnemonique_type: id_nomenclature}.
+        The defaults change rarely: the result is kept in memory
+        (per process) for `timeout` seconds for each set of parameters
+    """
+    # the time bucket in the key expires the entries; the number of
+    # entries is bounded by the lru_cache, whatever the parameters
+    bucket = int(time.monotonic() // timeout)
+    return _get_default_nomenclatures(int(organism), regne, group2_inpn, bucket)
+
+
+@lru_cache(maxsize=128)
+def _get_default_nomenclatures(organism, regne, group2_inpn, bucket):
+    mnemonique_type = column("mnemonique_type")
+    q = DB.session.query(mnemonique_type, column("id_nomenclature")).select_from(
+        func.pr_occtax.get_default_nomenclature_values(organism, regne, group2_inpn)
+    )
+    return {d[0]: d[1] for d in q.all()}
+
+
+def filter_keys(values, allowed_keys, none_id=None):
+    """
+        Return the posted dict `values` reduced to the keys
+        of the frozenset `allowed_keys` (set intersection),
+        without the key `none_id` if its value is None
+    """
+    values = {k: values[k] for k in values.keys() & allowed_keys}
+    if none_id in values and values[none_id] is None:
+        del values[none_id]
+    return values
@@ -40,6 +40,28 @@ AS $$
   END;
 $$;
 
+CREATE OR REPLACE FUNCTION get_default_nomenclature_values(myidorganism integer DEFAULT 0, myregne character varying(20) DEFAULT '0', mygroup2inpn character varying(255) DEFAULT '0')
+RETURNS TABLE(mnemonique_type character varying, id_nomenclature integer)
+STABLE
+LANGUAGE sql
+AS $$
+--Function that return the default nomenclature id of every nomenclature type with wanteds organism id, regne, group2_inpn
+--Same rules as get_default_nomenclature_value, but all the types are resolved in one query
+--A type without matching default is returned with a NULL id_nomenclature
+  SELECT t.mnemonique_type, d.id_nomenclature
+  FROM (SELECT DISTINCT mnemonique_type FROM pr_occtax.defaults_nomenclatures_value) t
+  LEFT JOIN LATERAL (
+    SELECT v.id_nomenclature
+    FROM pr_occtax.defaults_nomenclatures_value v
+    WHERE v.mnemonique_type = t.mnemonique_type
+    AND (v.id_organism = 0 OR v.id_organism = myidorganism)
+    AND (v.regne = '0' OR v.regne = myregne)
+    AND (v.group2_inpn = '0' OR v.group2_inpn = mygroup2inpn)
+    ORDER BY v.group2_inpn DESC, v.regne DESC, v.id_organism DESC
+    LIMIT 1
+  ) d ON true;
+$$;
+
 CREATE OR REPLACE FUNCTION get_id_counting_from_id_releve(my_id_releve integer)
   RETURNS integer[] AS
 $BODY$
@@ -555,6 +577,17 @@ ALTER TABLE ONLY defaults_nomenclatures_value
     ADD CONSTRAINT check_pr_occtax_defaults_nomenclatures_value_isregne CHECK (taxonomie.check_is_regne(regne::text) OR regne::text = '0'::text) NOT VALID;
 
 
+-----------
+--INDEXES--
+-----------
+
+CREATE INDEX i_t_releves_occtax_date_min ON t_releves_occtax USING btree (date_min DESC);
+
+CREATE INDEX i_t_occurrences_occtax_id_releve_occtax ON t_occurrences_occtax USING btree (id_releve_occtax);
+
+CREATE INDEX i_cor_counting_occtax_id_occurrence_occtax ON cor_counting_occtax USING btree (id_occurrence_occtax);
+
+
 ----------------------
 --FUNCTIONS TRIGGERS--
 ----------------------
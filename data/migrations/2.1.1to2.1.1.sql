@@ -21,3 +21,35 @@ END;
 $BODY$
   LANGUAGE plpgsql VOLATILE
   COST 100;
+
+
+-- Occtax : valeurs par défaut de toutes les nomenclatures en une seule requête
+CREATE OR REPLACE FUNCTION pr_occtax.get_default_nomenclature_values(myidorganism integer DEFAULT 0, myregne character varying(20) DEFAULT '0', mygroup2inpn character varying(255) DEFAULT '0')
+RETURNS TABLE(mnemonique_type character varying, id_nomenclature integer)
+STABLE
+LANGUAGE sql
+AS $$
+--Function that return the default nomenclature id of every nomenclature type with wanteds organism id, regne, group2_inpn
+--Same rules as get_default_nomenclature_value, but all the types are resolved in one query
+--A type without matching default is returned with a NULL id_nomenclature
+  SELECT t.mnemonique_type, d.id_nomenclature
+  FROM (SELECT DISTINCT mnemonique_type FROM pr_occtax.defaults_nomenclatures_value) t
+  LEFT JOIN LATERAL (
+    SELECT v.id_nomenclature
+    FROM pr_occtax.defaults_nomenclatures_value v
+    WHERE v.mnemonique_type = t.mnemonique_type
+    AND (v.id_organism = 0 OR v.id_organism = myidorganism)
+    AND (v.regne = '0' OR v.regne = myregne)
+    AND (v.group2_inpn = '0' OR v.group2_inpn = mygroup2inpn)
+    ORDER BY v.group2_inpn DESC, v.regne DESC, v.id_organism DESC
+    LIMIT 1
+  ) d ON true;
+$$;
+
+
+-- Occtax : index sur le tri des relevés par date et sur les clés étrangères des jointures relevé/occurrence/dénombrement
+CREATE INDEX IF NOT EXISTS i_t_releves_occtax_date_min ON pr_occtax.t_releves_occtax USING btree (date_min DESC);
+
+CREATE INDEX IF NOT EXISTS i_t_occurrences_occtax_id_releve_occtax ON pr_occtax.t_occurrences_occtax USING btree (id_releve_occtax);
+
+CREATE INDEX IF NOT EXISTS i_cor_counting_occtax_id_occurrence_occtax ON pr_occtax.cor_counting_occtax USING btree (id_occurrence_occtax);